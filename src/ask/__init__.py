@@ -1,2 +1,2 @@
 __all__ = ["__version__"]
-__version__ = "0.1.0"
\ No newline at end of file
+__version__ = "0.2.2"
\ No newline at end of file
@@ -1,20 +1,32 @@
+from __future__ import annotations
+
 import argparse
-import json
+import atexit
+import codecs
+import functools
+import hashlib
 import os
+import shlex
+import shutil
 import subprocess
+import tempfile
+from collections import deque
 from dataclasses import dataclass
-from typing import Any, Dict, List
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple, Union
+
+import msgspec
+import orjson
 
-import requests
-from platformdirs import user_config_dir
-from prompt_toolkit import PromptSession
-from prompt_toolkit.completion import PathCompleter
-from prompt_toolkit.history import FileHistory
-from rich.console import Console
-from rich.panel import Panel
-from rich.text import Text
+if TYPE_CHECKING:
+    # rich, prompt_toolkit, requests and asyncio are imported where they are used so
+    # that `ask --help` / `ask --reset` don't pay for loading them.
+    import asyncio
 
-console = Console()
+    import requests
+    from prompt_toolkit import PromptSession
+    from prompt_toolkit.completion import Completer
+    from rich.console import Console, Group
+    from rich.panel import Panel
 
 DEFAULT_BASE_URL = os.environ.get("LMSTUDIO_BASE_URL", "http://localhost:1234")
 DEFAULT_ENDPOINT = os.environ.get("LMSTUDIO_ENDPOINT", "/v1/chat/completions")
@@ -86,6 +98,10 @@ User: "is it normal to feel anxious before presentations?"
 Assistant: {"type":"answer","message":"Give reassurance and practical tips...","command":""}
 """
 
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+# The system prompt never changes, so it is JSON-encoded once rather than on every request
+_SYSTEM_MESSAGE_BYTES = orjson.dumps(SYSTEM_MESSAGE)
+
 @dataclass
 class LLMConfig:
     base_url: str
@@ -93,8 +109,34 @@ class LLMConfig:
     model: str
     temperature: float = 0.0
     timeout_s: int = 60
+    cache: bool = True
+
+@functools.lru_cache(maxsize=None)
+def get_console() -> Console:
+    from rich.console import Console
+
+    return Console()
+
+class LLMReply(msgspec.Struct):
+    # Models often send null for fields they don't use; treat that like a missing field
+    type: Optional[str] = "answer"
+    message: Optional[str] = ""
+    command: Optional[str] = ""
+    follow_up: Optional[bool] = False
+
+    def __post_init__(self) -> None:
+        if self.type is None:
+            self.type = "answer"
+        if self.message is None:
+            self.message = ""
+        if self.command is None:
+            self.command = ""
+        if self.follow_up is None:
+            self.follow_up = False
 
 def config_dir() -> str:
+    from platformdirs import user_config_dir
+
     d = user_config_dir("ask-cli")
     os.makedirs(d, exist_ok=True)
     return d
@@ -102,91 +144,549 @@ def config_dir() -> str:
 def history_path() -> str:
     return os.path.join(config_dir(), "history.txt")
 
+def cache_dir() -> str:
+    return os.path.join(config_dir(), "cache")
+
 def session_path() -> str:
-    return os.path.join(config_dir(), "session.json")
+    return os.path.join(config_dir(), "session.jsonl")
 
-def load_session() -> List[Dict[str, str]]:
+def load_session(limit: Optional[int] = None) -> List[Dict[str, str]]:
+    # One JSON message per line; with a limit only the most recent messages are kept
+    messages: deque = deque(maxlen=limit)
     try:
-        with open(session_path(), "r", encoding="utf-8") as f:
-            data = json.load(f)
-        if isinstance(data, list):
-            return data
+        with open(session_path(), "rb") as f:
+            for line in f:
+                try:
+                    message = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # Skip a corrupt (e.g. half-written) line rather than the whole session
+                    continue
+                if isinstance(message, dict):
+                    messages.append(message)
     except FileNotFoundError:
         pass
-    except Exception:
-        # If session corrupt, just start fresh
-        pass
-    return []
+    return list(messages)
 
 def save_session(messages: List[Dict[str, str]]) -> None:
-    with open(session_path(), "w", encoding="utf-8") as f:
-        json.dump(messages, f, ensure_ascii=False, indent=2)
+    # Write a temp file and rename over the original so a crash never leaves a torn session
+    path = session_path()
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.writelines(orjson.dumps(m) + b"\n" for m in messages)
+    os.replace(tmp, path)
+
+SESSION_FLUSH_EVERY = 8
+_pending_session: List[Dict[str, str]] = []
+
+def append_session(message: Dict[str, str]) -> None:
+    # Appends are buffered and written in batches; anything left is flushed at exit
+    _pending_session.append(message)
+    if len(_pending_session) >= SESSION_FLUSH_EVERY:
+        flush_session()
+
+def flush_session() -> None:
+    if not _pending_session:
+        return
+    with open(session_path(), "ab") as f:
+        f.writelines(orjson.dumps(m) + b"\n" for m in _pending_session)
+    _pending_session.clear()
+
+atexit.register(flush_session)
 
 def clear_session() -> None:
+    _pending_session.clear()
     try:
         os.remove(session_path())
     except FileNotFoundError:
         pass
 
-def call_llm(cfg: LLMConfig, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+_SESSION: Optional[requests.Session] = None
+
+def http_session() -> requests.Session:
+    # One keep-alive connection pool per process so follow-up turns reuse the socket
+    global _SESSION
+    if _SESSION is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        _SESSION = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        _SESSION.mount("http://", adapter)
+        _SESSION.mount("https://", adapter)
+    return _SESSION
+
+WARM_TIMEOUT_S = 1.5
+
+def warm_connection(cfg: LLMConfig) -> None:
+    # Open (or refresh) the pooled keep-alive socket so the next call_llm skips connection setup
+    import requests
+
+    try:
+        http_session().head(cfg.base_url, timeout=WARM_TIMEOUT_S).close()
+    except requests.RequestException:
+        pass
+
+def _read_stream(r: requests.Response, on_delta: Optional[Callable[[str], None]] = None) -> str:
+    # Server-sent events: one "data: {...}" line per chunk, terminated by "data: [DONE]"
+    parts: List[str] = []
+    for line in r.iter_lines():
+        if not line.startswith(b"data:"):
+            continue
+        chunk = line[len(b"data:"):].strip()
+        if chunk == b"[DONE]":
+            break
+        choices = orjson.loads(chunk).get("choices") or []
+        if not choices:
+            continue
+        delta = (choices[0].get("delta") or {}).get("content")
+        if delta:
+            parts.append(delta)
+            if on_delta:
+                on_delta(delta)
+    return "".join(parts)
+
+def _request_body(cfg: LLMConfig, messages: List[Dict[str, str]]) -> bytes:
+    head = (
+        b'{"model":' + orjson.dumps(cfg.model)
+        + b',"temperature":' + orjson.dumps(cfg.temperature)
+        + b',"stream":true,"messages":'
+    )
+    if len(messages) > 1 and messages[0] == SYSTEM_MESSAGE:
+        # Splice the pre-encoded system message in front of the encoded remainder
+        return head + b"[" + _SYSTEM_MESSAGE_BYTES + b"," + orjson.dumps(messages[1:])[1:] + b"}"
+    return head + orjson.dumps(messages) + b"}"
+
+def call_llm(
+    cfg: LLMConfig,
+    messages: List[Dict[str, str]],
+    on_delta: Optional[Callable[[str], None]] = None,
+) -> LLMReply:
     url = cfg.base_url.rstrip("/") + cfg.endpoint
-    payload = {
-        "model": cfg.model,
-        "messages": messages,
-        "temperature": cfg.temperature,
-    }
-    r = requests.post(url, json=payload, timeout=cfg.timeout_s)
-    r.raise_for_status()
-    data = r.json()
-    content = data["choices"][0]["message"]["content"]
+    body = _request_body(cfg, messages)
+    # Only deterministic (temperature 0) replies are worth reusing
+    cache_path = _cache_path(body) if cfg.cache and cfg.temperature == 0.0 else None
+    if cache_path:
+        try:
+            with open(cache_path, "rb") as f:
+                return parse_reply(f.read().decode("utf-8"))
+        except FileNotFoundError:
+            pass
+
+    headers = {"Content-Type": "application/json"}
+    with http_session().post(url, data=body, headers=headers, stream=True, timeout=cfg.timeout_s) as r:
+        r.raise_for_status()
+        content = _read_stream(r, on_delta)
+
+    try:
+        reply = msgspec.json.decode(content, type=LLMReply, strict=False)
+    except msgspec.DecodeError:
+        # Empty, truncated or malformed replies get the debugging fallback and are never cached
+        return parse_reply(content)
+
+    if cache_path:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Unique temp name: concurrent identical requests (e.g. --batch duplicates) must not collide
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content.encode("utf-8"))
+        os.replace(tmp, cache_path)
+    return reply
+
+def _cache_path(body: bytes) -> str:
+    # The request body already covers model, temperature and every message
+    key = hashlib.sha256(body).hexdigest()
+    return os.path.join(cache_dir(), key[:2], key)
+
+def parse_reply(content: str) -> LLMReply:
     try:
-        parsed = json.loads(content)
-    except Exception as e:
+        return msgspec.json.decode(content, type=LLMReply, strict=False)
+    except msgspec.ValidationError as e:
+        parsed = msgspec.json.decode(content)
+        if not isinstance(parsed, dict):
+            return LLMReply(message=str(parsed))
         # Fall back: show raw content for debugging
-        return {
-            "type": "answer",
-            "message": f"{content}\n\n[Non-JSON response: {e}]",
-            "command": "",
-            "follow_up": False,
-        }
-
-    if not isinstance(parsed, dict):
-        return {
-            "type": "answer",
-            "message": str(parsed),
-            "command": "",
-            "follow_up": False,
-        }
-
-    parsed.setdefault("follow_up", False)
-    parsed.setdefault("message", "")
-    parsed.setdefault("command", "")
-    parsed.setdefault("type", "answer")
-    return parsed
+        return LLMReply(message=f"{content}\n\n[Invalid response: {e}]")
+    except msgspec.DecodeError as e:
+        # Fall back: show raw content for debugging
+        return LLMReply(message=f"{content}\n\n[Non-JSON response: {e}]")
+
+def compact_reply(reply: LLMReply) -> str:
+    # The model only needs what it said (and proposed), not the JSON envelope around it
+    if reply.command:
+        return f"{reply.message}\nCommand: {reply.command}".strip()
+    return reply.message
+
+def compact_message(message: Dict[str, str]) -> Dict[str, str]:
+    # Session logs keep the raw assistant JSON; turn it back into the compact form on load
+    if message.get("role") != "assistant":
+        return message
+    try:
+        reply = msgspec.json.decode(message.get("content", ""), type=LLMReply, strict=False)
+    except msgspec.DecodeError:
+        return message
+    return {"role": "assistant", "content": compact_reply(reply)}
+
+def context_prefix() -> List[Dict[str, str]]:
+    # Pin the system prompt and cwd (helpful for “this file”) ahead of the history. Keeping this
+    # prefix byte-identical across turns lets the server reuse its cached prompt evaluation.
+    return [
+        SYSTEM_MESSAGE,
+        {"role": "system", "content": f"The user's current directory is: {os.getcwd()}"},
+    ]
+
+BATCH_WORKERS = 4
+
+def run_batch(cfg: LLMConfig, queries: List[str]) -> List[Union[LLMReply, Exception]]:
+    # Independent requests in flight together let the server batch their prefill; order is kept.
+    # A failed request yields its exception in place so the other replies are still shown.
+    from concurrent.futures import ThreadPoolExecutor
+
+    import requests
+
+    prefix = context_prefix()
+
+    def ask_one(query: str) -> Union[LLMReply, Exception]:
+        try:
+            return call_llm(cfg, prefix + [{"role": "user", "content": query}])
+        except requests.RequestException as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as pool:
+        return list(pool.map(ask_one, queries))
+
+def prompt_window(messages: List[Dict[str, str]], turns: int) -> List[Dict[str, str]]:
+    # Send the leading system messages plus the last `turns` exchanges; 0 sends everything
+    if turns <= 0:
+        return messages
+    head = 0
+    while head < len(messages) and messages[head].get("role") == "system":
+        head += 1
+    return messages[:head] + messages[max(head, len(messages) - 2 * turns):]
 
 def pretty_command(cmd: str) -> Panel:
+    from rich.panel import Panel
+    from rich.text import Text
+
     t = Text(cmd)
     return Panel(t, title="Command", border_style="green")
 
 def pretty_message(msg: str) -> Panel:
+    from rich.panel import Panel
+    from rich.text import Text
+
     return Panel(Text(msg), title="Assistant", border_style="cyan")
 
 def pretty_user(msg: str) -> Panel:
+    from rich.panel import Panel
+    from rich.text import Text
+
     return Panel(Text(msg), title="You", border_style="magenta")
 
-def run_shell_command(cmd: str) -> subprocess.CompletedProcess:
-    # Run using user's shell for normal zsh compatibility, but safely.
-    # We avoid shell=True; instead invoke /bin/zsh -lc "<cmd>"
-    return subprocess.run(
-        ["/bin/zsh", "-lc", cmd],
-        text=True,
-        capture_output=True,
+def pretty_output(output: str, title: str, border_style: str) -> Panel:
+    from rich.panel import Panel
+    from rich.text import Text
+
+    return Panel(Text(output), title=title, border_style=border_style)
+
+MAX_OUTPUT_BYTES = 4096
+# Each stream keeps its first and last CAPTURE_BYTES; anything in between is counted, not stored
+CAPTURE_BYTES = 64 * 1024
+
+class OutputCapture:
+    def __init__(self, limit: Optional[int] = None) -> None:
+        self.limit = limit or CAPTURE_BYTES
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def feed(self, data: bytes) -> None:
+        self.total += len(data)
+        room = self.limit - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if data:
+            self.tail += data
+            # Trim lazily so the ring costs amortised O(1) per byte
+            if len(self.tail) > 2 * self.limit:
+                del self.tail[: -self.limit]
+
+    @property
+    def dropped(self) -> bool:
+        return len(self.head) + min(len(self.tail), self.limit) < self.total
+
+    def render(self, max_bytes: Optional[int] = None) -> str:
+        # Head and tail of the stream, with the true number of missing bytes marked in between
+        head, tail = bytes(self.head), bytes(self.tail[-self.limit:])
+        if not self.dropped:
+            data = head + tail
+            if max_bytes is None or len(data) <= max_bytes:
+                return data.decode("utf-8", errors="replace")
+            head, tail = data, data
+        if max_bytes is not None:
+            half = max_bytes // 2
+            head, tail = head[:half], tail[len(tail) - half:]
+        elided = self.total - len(head) - len(tail)
+        return (
+            f"{head.decode('utf-8', errors='ignore')}\n...[{elided} bytes elided]...\n"
+            f"{tail.decode('utf-8', errors='ignore')}"
+        )
+
+class CommandResult(subprocess.CompletedProcess):
+    # stdout/stderr hold the captured text, elided in the middle if a stream outgrew its capture
+    def __init__(self, args: List[str], returncode: int, stdout: OutputCapture, stderr: OutputCapture) -> None:
+        super().__init__(args, returncode, stdout.render(), stderr.render())
+        self.stdout_capture = stdout
+        self.stderr_capture = stderr
+
+CHUNK_BYTES = 4096
+LIVE_PREVIEW_LINES = 20
+
+OutputCallback = Callable[[str, str], None]
+
+async def _pump(stream: asyncio.StreamReader, name: str, sink: OutputCapture, on_output: Optional[OutputCallback]) -> None:
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    while True:
+        data = await stream.read(CHUNK_BYTES)
+        sink.feed(data)
+        if on_output:
+            text = decoder.decode(data, final=not data)
+            if text:
+                on_output(name, text)
+        if not data:
+            break
+
+async def _run_process_async(argv: List[str], on_output: Optional[OutputCallback]) -> CommandResult:
+    import asyncio
+
+    proc = await asyncio.create_subprocess_exec(
+        *argv,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
     )
+    stdout = OutputCapture()
+    stderr = OutputCapture()
+    await asyncio.gather(
+        _pump(proc.stdout, "stdout", stdout, on_output),
+        _pump(proc.stderr, "stderr", stderr, on_output),
+    )
+    returncode = await proc.wait()
+    return CommandResult(argv, returncode, stdout, stderr)
+
+def _run_process(argv: List[str], on_output: Optional[OutputCallback] = None) -> CommandResult:
+    # Both pipes are drained concurrently and handed to on_output(stream_name, text) as they arrive
+    import asyncio
+
+    return asyncio.run(_run_process_async(argv, on_output))
+
+# Characters that mean the command relies on shell syntax (pipes, redirects, globs, expansion, ...)
+_SHELL_CHARS = frozenset("|&;<>()$`*?[]{}~#!\n")
+
+# zsh builtins and reserved words. Several also exist on PATH (/bin/echo, /usr/bin/which, ...) but
+# behave differently from the builtin, so these always go through zsh.
+_ZSH_BUILTINS = frozenset(
+    """
+    . alias autoload bg builtin bye case cd chdir command declare dirs disown do done echo elif else
+    emulate enable esac eval exec exit export false fc fg fi float for function functions getopts hash
+    history if integer jobs kill let limit local logout noglob popd print printf pushd pwd read
+    readonly rehash repeat return select set setopt shift source suspend test then time times trap
+    true ttyctl type typeset ulimit umask unalias unfunction unhash unlimit unset unsetopt until wait
+    whence where which while zmodload
+    """.split()
+)
+
+def _direct_argv(cmd: str) -> Optional[List[str]]:
+    # Simple commands are exec'd directly, skipping shell startup; None means "needs zsh"
+    if any(c in _SHELL_CHARS for c in cmd):
+        return None
+    try:
+        argv = shlex.split(cmd)
+    except ValueError:
+        return None
+    # Env assignments, builtins and aliases/functions (not found on PATH) still need the shell
+    if not argv or "=" in argv[0] or argv[0] in _ZSH_BUILTINS or shutil.which(argv[0]) is None:
+        return None
+    # zsh's EQUALS option expands a leading "=" (=python3 -> /usr/bin/python3)
+    if any(word.startswith("=") for word in argv):
+        return None
+    return argv
+
+def run_shell_command(cmd: str, on_output: Optional[OutputCallback] = None) -> CommandResult:
+    # Run using user's shell for normal zsh compatibility, but safely.
+    # We avoid shell=True; instead invoke /bin/zsh -c "<cmd>" (-lc with ASK_LOGIN_SHELL set)
+    argv = _direct_argv(cmd)
+    if argv is None:
+        argv = ["/bin/zsh", "-lc" if os.environ.get("ASK_LOGIN_SHELL") else "-c", cmd]
+    return _run_process(argv, on_output)
+
+def run_with_live_output(cmd: str) -> CommandResult:
+    # Preview the tail of each stream while the command runs; the caller prints the full result
+    from rich.console import Group
+    from rich.live import Live
+    from rich.spinner import Spinner
+    from rich.text import Text
+
+    tails = {"stdout": "", "stderr": ""}
+
+    def render() -> Group:
+        panels = [
+            pretty_output("\n".join(tails[name].splitlines()[-LIVE_PREVIEW_LINES:]), name, style)
+            for name, style in (("stdout", "green"), ("stderr", "red"))
+            if tails[name]
+        ]
+        return Group(Spinner("dots", text=Text(cmd, style="dim")), *panels)
+
+    with Live(render(), console=get_console(), transient=True, refresh_per_second=10) as live:
+
+        def on_output(name: str, text: str) -> None:
+            tails[name] = (tails[name] + text)[-CHUNK_BYTES:]
+            live.update(render())
+
+        return run_shell_command(cmd, on_output)
+
+@functools.lru_cache(maxsize=None)
+def path_completer() -> Completer:
+    from prompt_toolkit.completion import PathCompleter
 
-def interactive_followups(session: PromptSession, prompt_text: str) -> str:
     # PathCompleter enables TAB completion for files/folders
-    path_completer = PathCompleter(expanduser=True)
-    return session.prompt(prompt_text, completer=path_completer)
+    return PathCompleter(expanduser=True)
+
+@functools.lru_cache(maxsize=None)
+def no_completer() -> Completer:
+    from prompt_toolkit.completion import DummyCompleter
+
+    return DummyCompleter()
+
+def interactive_followups(session: PromptSession, prompt_text: str) -> str:
+    # PromptSession.prompt() keeps the completer it is given, so every prompt sets its own
+    return session.prompt(prompt_text, completer=path_completer())
+
+def confirm(session: PromptSession, prompt_text: str) -> bool:
+    # Yes/no questions get no file-path completion
+    return session.prompt(prompt_text, completer=no_completer()).strip().lower() in ("y", "yes")
+
+_GREETING = 'Hi! Describe what you want in plain English, e.g. ask "find the five largest files here".'
+_FAST_PATH = {
+    "hi": _GREETING,
+    "hello": _GREETING,
+    "hey": _GREETING,
+    "help": (
+        "Describe what you want to do in plain English and I'll suggest a zsh command or answer directly. "
+        "Run `ask --help` to see the available options."
+    ),
+}
+
+def fast_path_reply(query: str) -> Optional[str]:
+    # Trivial queries are answered locally instead of paying for a full LLM round trip
+    key = query.strip().lower().rstrip("!?. ")
+    if key == "version":
+        from importlib.metadata import PackageNotFoundError, version
+
+        try:
+            return f"ask {version('ask-cli')}"
+        except PackageNotFoundError:
+            from ask import __version__
+
+            return f"ask {__version__}"
+    return _FAST_PATH.get(key)
+
+CONTINUE = "continue"
+BREAK = "break"
+
+@dataclass
+class TurnContext:
+    args: argparse.Namespace
+    cfg: LLMConfig
+    session: PromptSession
+
+    def follow_up_allowed(self, result: LLMReply) -> bool:
+        return result.follow_up and self.args.run
+
+# Each handler returns (CONTINUE | BREAK, user message to record next or None)
+HandlerResult = Tuple[str, Optional[str]]
+
+def handle_question(turn: TurnContext, result: LLMReply) -> HandlerResult:
+    console = get_console()
+    answer = interactive_followups(turn.session, "Answer: ").strip()
+
+    if not answer:
+        console.print("[yellow]No answer provided. Exiting.[/yellow]")
+        return BREAK, None
+    console.print(pretty_user(answer))
+    return CONTINUE, answer
+
+def handle_answer(turn: TurnContext, result: LLMReply) -> HandlerResult:
+    return (CONTINUE if turn.follow_up_allowed(result) else BREAK), None
+
+def handle_command(turn: TurnContext, result: LLMReply) -> HandlerResult:
+    import threading
+
+    console = get_console()
+    cmd = result.command.strip()
+    console.print(pretty_command(cmd))
+
+    # Confirmation before running
+    if turn.args.yes:
+        do_run = True
+    elif turn.args.run:
+        do_run = confirm(turn.session, "Run this? [y/N]: ")
+    else:
+        do_run = False
+
+    if not do_run:
+        return BREAK, None
+
+    follow_up_allowed = turn.follow_up_allowed(result)
+    console.print("[bold]Running…[/bold]")
+    warm_up = None
+    if follow_up_allowed:
+        # Another LLM turn follows, so connect to the server while the command runs
+        warm_up = threading.Thread(target=warm_connection, args=(turn.cfg,), daemon=True)
+        warm_up.start()
+    completed = run_with_live_output(cmd)
+    console.print(f"[bold]Exit code:[/bold] {completed.returncode}")
+    for name, style, capture in (
+        ("stdout", "green", completed.stdout_capture),
+        ("stderr", "red", completed.stderr_capture),
+    ):
+        if capture.total:
+            title = f"{name} (truncated)" if capture.dropped else name
+            console.print(pretty_output(capture.render().rstrip(), title, style))
+    # Tell the model what happened for next time (capped so the prompt stays small)
+    stdout = completed.stdout_capture.render(MAX_OUTPUT_BYTES)
+    stderr = completed.stderr_capture.render(MAX_OUTPUT_BYTES)
+    outcome = (
+        f"The command returned exit code {completed.returncode}.\n"
+        f"STDOUT:\n{stdout}\nSTDERR:\n{stderr}"
+    )
+    if warm_up is not None:
+        # Output is already on screen; let the (short) warm-up finish before the next call_llm
+        # uses the shared session
+        warm_up.join(WARM_TIMEOUT_S)
+    return (CONTINUE if follow_up_allowed else BREAK), outcome
+
+def handle_missing_command(turn: TurnContext, result: LLMReply) -> HandlerResult:
+    get_console().print("[red]LLM returned type=command but no command.[/red]")
+    return BREAK, None
+
+def handle_unknown(turn: TurnContext, result: LLMReply) -> HandlerResult:
+    get_console().print("[red]LLM returned unknown type. Exiting.[/red]")
+    return BREAK, None
+
+HANDLERS: Dict[str, Callable[[TurnContext, LLMReply], HandlerResult]] = {
+    "question": handle_question,
+    "answer": handle_answer,
+    "command": handle_command,
+}
+
+# Broken replies end the conversation without being recorded in the history or session log
+_UNRECORDED = (handle_missing_command, handle_unknown)
+
+def select_handler(result: LLMReply) -> Callable[[TurnContext, LLMReply], HandlerResult]:
+    rtype = result.type.strip().lower()
+    if rtype == "command" and not result.command.strip():
+        return handle_missing_command
+    return HANDLERS.get(rtype, handle_unknown)
 
 def main():
     parser = argparse.ArgumentParser(prog="ask", description="Plain-English to shell commands via LM Studio")
@@ -200,6 +700,9 @@ def main():
     parser.set_defaults(session=False)
     parser.add_argument("--session", dest="session", action="store_true", help="Persist conversation session across invocations")
     parser.add_argument("--no-session", dest="session", action="store_false", help="Disable session persistence (default)")
+    parser.add_argument("--context-turns", type=int, default=6, help="Recent exchanges sent to the LLM each turn; 0 sends the full history (default: 6)")
+    parser.add_argument("--no-cache", dest="cache", action="store_false", help="Always query the LLM instead of reusing cached replies")
+    parser.add_argument("--batch", metavar="PATH", help="Answer each line of PATH as a separate request, in parallel (commands are shown, not run)")
     parser.add_argument("--reset", action="store_true", help="Reset the saved conversation session")
     args = parser.parse_args()
 
@@ -208,13 +711,44 @@ def main():
         endpoint=args.endpoint,
         model=args.model,
         temperature=args.temperature,
+        cache=args.cache,
     )
 
+    console = get_console()
+
     if args.reset:
         clear_session()
         console.print("[green]Session cleared.[/green]")
         return
 
+    from rich.markup import escape
+
+    if args.batch:
+        try:
+            with open(args.batch, "r", encoding="utf-8") as f:
+                queries = [line.strip() for line in f if line.strip()]
+        except (OSError, UnicodeDecodeError) as e:
+            console.print(f"[red]Cannot read batch file: {escape(str(e))}[/red]")
+            return
+        if not queries:
+            console.print(f"[yellow]No requests in {escape(args.batch)}.[/yellow]")
+            return
+        with console.status(f"[bold green]Asking the AI ({len(queries)} requests)...[/bold green]"):
+            replies = run_batch(cfg, queries)
+        for query, reply in zip(queries, replies):
+            console.print(pretty_user(query))
+            if isinstance(reply, Exception):
+                console.print(f"[red]Request failed: {escape(str(reply))}[/red]")
+                continue
+            if reply.message.strip():
+                console.print(pretty_message(reply.message.strip()))
+            if reply.type.strip().lower() == "command" and reply.command.strip():
+                console.print(pretty_command(reply.command.strip()))
+        return
+
+    from prompt_toolkit import PromptSession
+    from prompt_toolkit.history import FileHistory
+
     # Prompt session with persisted history (shell-like up-arrow)
     session = PromptSession(history=FileHistory(history_path()))
 
@@ -229,100 +763,59 @@ def main():
 
     console.print(pretty_user(query))
 
+    reply = fast_path_reply(query)
+    if reply is not None:
+        console.print(pretty_message(reply))
+        return
+
     # Load or start messages
     messages: List[Dict[str, str]] = []
     if args.session:
-        messages = load_session()
+        limit = 2 * args.context_turns if args.context_turns > 0 else None
+        messages = [compact_message(m) for m in load_session(limit=limit)]
+
+    messages = context_prefix() + [m for m in messages if m.get("role") != "system"]
 
-    # Ensure system prompt exists at start
-    if not messages or messages[0].get("role") != "system":
-        messages = [{"role": "system", "content": SYSTEM_PROMPT}] + [m for m in messages if m.get("role") != "system"]
+    def record(message: Dict[str, str], raw: Optional[Dict[str, str]] = None) -> None:
+        # Keep the conversation in memory and append it (or its raw form) to the session log
+        messages.append(message)
+        if args.session:
+            append_session(raw or message)
 
-    # Add context about cwd (helpful for “this file”)
-    cwd = os.getcwd()
-    messages.append({"role": "user", "content": f"My current directory is: {cwd}\nRequest: {query}"})
+    record({"role": "user", "content": query})
+    turn = TurnContext(args=args, cfg=cfg, session=session)
 
     # Loop: LLM may ask follow-ups
     while True:
-        with console.status("[bold green]Asking the AI...[/bold green]"):
-            result = call_llm(cfg, messages)
-        rtype = (result.get("type") or "").strip().lower()
-        msg = (result.get("message") or "").strip()
-        cmd = (result.get("command") or "").strip()
-        follow_up = bool(result.get("follow_up"))
-        follow_up_allowed = follow_up and args.run
+        with console.status("[bold green]Asking the AI...[/bold green]") as status:
+            tail = ""
 
-        if msg:
-            console.print(pretty_message(msg))
+            def show_progress(delta: str) -> None:
+                # The reply is raw JSON, so show its tail in the spinner rather than the panel
+                nonlocal tail
+                tail = (tail + delta.replace("\n", " "))[-60:]
+                status.update(f"[bold green]Asking the AI...[/bold green] [dim]{escape(tail)}[/dim]")
 
-        if rtype == "question":
-            messages.append({"role": "assistant", "content": json.dumps(result)})
-            answer = interactive_followups(session, "Answer: ").strip()
+            result = call_llm(cfg, prompt_window(messages, args.context_turns), on_delta=show_progress)
+        msg = result.message.strip()
 
-            if not answer:
-                console.print("[yellow]No answer provided. Exiting.[/yellow]")
-                break
-            console.print(pretty_user(answer))
-            messages.append({"role": "user", "content": answer})
-            continue
-
-        if rtype == "answer":
-            messages.append({"role": "assistant", "content": json.dumps(result)})
-            if follow_up_allowed:
-                continue
-            break
-
-        if rtype == "command":
-            if not cmd:
-                console.print("[red]LLM returned type=command but no command.[/red]")
-                break
-
-            console.print(pretty_command(cmd))
-
-            # Confirmation before running
-            if args.yes:
-                do_run = True
-            elif args.run:
-                yn = session.prompt("Run this? [y/N]: ").strip().lower()
-                do_run = yn in ("y", "yes")
-            else:
-                do_run = False
-
-            if do_run:
-                console.print("[bold]Running…[/bold]")
-                completed = run_shell_command(cmd)
-                console.print(f"[bold]Exit code:[/bold] {completed.returncode}")
-                if completed.stdout:
-                    console.print(Panel(Text(completed.stdout.rstrip()), title="stdout", border_style="green"))
-                if completed.stderr:
-                    console.print(Panel(Text(completed.stderr.rstrip()), title="stderr", border_style="red"))
-                # Tell the model what happened for next time
-                messages.append({"role": "assistant", "content": json.dumps(result)})
-                messages.append(
-                    {
-                        "role": "user",
-                        "content": (
-                            f"The command returned exit code {completed.returncode}.\n"
-                            f"STDOUT:\n{completed.stdout}\nSTDERR:\n{completed.stderr}"
-                        ),
-                    }
-                )
-                if follow_up_allowed:
-                    continue
-                break
+        if msg:
+            console.print(pretty_message(msg))
 
-            # Still record assistant output for continuity
-            messages.append({"role": "assistant", "content": json.dumps(result)})
-            if follow_up_allowed and do_run:
-                continue
+        handler = select_handler(result)
+        if handler not in _UNRECORDED:
+            record(
+                {"role": "assistant", "content": compact_reply(result)},
+                raw={"role": "assistant", "content": msgspec.json.encode(result).decode()},
+            )
+        action, user_content = handler(turn, result)
+        if user_content is not None:
+            record({"role": "user", "content": user_content})
+        if action == BREAK:
             break
 
-        # Unknown response type
-        console.print("[red]LLM returned unknown type. Exiting.[/red]")
-        break
-
     if args.session:
-        save_session(messages)
+        flush_session()
 
 if __name__ == "__main__":
     main()
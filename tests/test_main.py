@@ -1,19 +1,39 @@
+import argparse
 import json
+import pathlib
+import re
+import subprocess
+import sys
 
+import requests
+
+import ask
 import ask.main as ask_main
 
 
 class DummyResponse:
-    """Simple stand-in for the requests.Response API we rely on."""
+    """Simple stand-in for the streaming requests.Response API we rely on."""
+
+    def __init__(self, content, chunk_size=4):
+        # Split the completion into SSE chunks the way LM Studio streams them.
+        self._lines = []
+        for i in range(0, len(content), chunk_size):
+            chunk = {"choices": [{"delta": {"content": content[i : i + chunk_size]}}]}
+            self._lines.append(b"data: " + json.dumps(chunk).encode())
+            self._lines.append(b"")
+        self._lines.append(b"data: [DONE]")
+
+    def __enter__(self):
+        return self
 
-    def __init__(self, payload):
-        self._payload = payload
+    def __exit__(self, *exc):
+        return False
 
     def raise_for_status(self):
         return None
 
-    def json(self):
-        return self._payload
+    def iter_lines(self):
+        return iter(self._lines)
 
 
 def _llm_config():
@@ -22,6 +42,7 @@ def _llm_config():
         endpoint="/v1/chat/completions",
         model="stub",
         temperature=0.0,
+        cache=False,
     )
 
 
@@ -29,54 +50,247 @@ def test_call_llm_parses_valid_json(monkeypatch):
     """LLM responses that contain valid JSON should be returned as dicts."""
 
     def fake_post(*args, **kwargs):
-        payload = {
-            "choices": [
-                {
-                    "message": {
-                        "content": json.dumps(
-                            {"type": "answer", "message": "hi", "command": ""}
-                        )
-                    }
-                }
-            ]
-        }
-        return DummyResponse(payload)
+        return DummyResponse(json.dumps({"type": "answer", "message": "hi", "command": ""}))
 
-    monkeypatch.setattr(ask_main.requests, "post", fake_post)
+    monkeypatch.setattr(ask_main.http_session(), "post", fake_post)
 
     result = ask_main.call_llm(_llm_config(), [])
 
-    assert result == {"type": "answer", "message": "hi", "command": "", "follow_up": False}
+    assert result == ask_main.LLMReply(type="answer", message="hi", command="", follow_up=False)
 
 
 def test_call_llm_handles_non_json(monkeypatch):
     """When the LLM returns non-JSON, we should fall back to a readable error."""
 
     def fake_post(*args, **kwargs):
-        payload = {"choices": [{"message": {"content": "plain text"}}]}
-        return DummyResponse(payload)
+        return DummyResponse("plain text")
 
-    monkeypatch.setattr(ask_main.requests, "post", fake_post)
+    monkeypatch.setattr(ask_main.http_session(), "post", fake_post)
 
     result = ask_main.call_llm(_llm_config(), [])
 
-    assert result["type"] == "answer"
-    assert "plain text" in result["message"]
-    assert result["follow_up"] is False
+    assert result.type == "answer"
+    assert "plain text" in result.message
+    assert result.follow_up is False
 
 
 def test_call_llm_handles_scalar_json(monkeypatch):
     """If the LLM returns a valid JSON scalar (e.g., just a number), treat it as an answer."""
 
     def fake_post(*args, **kwargs):
-        payload = {"choices": [{"message": {"content": "13.2542"}}]}
-        return DummyResponse(payload)
+        return DummyResponse("13.2542")
 
-    monkeypatch.setattr(ask_main.requests, "post", fake_post)
+    monkeypatch.setattr(ask_main.http_session(), "post", fake_post)
 
     result = ask_main.call_llm(_llm_config(), [])
 
-    assert result == {"type": "answer", "message": "13.2542", "command": "", "follow_up": False}
+    assert result == ask_main.LLMReply(type="answer", message="13.2542", command="", follow_up=False)
+
+
+def test_parse_reply_coerces_and_validates():
+    """Replies decode into LLMReply, coercing string booleans and rejecting bad field types."""
+
+    reply = ask_main.parse_reply('{"type": "command", "command": "ls", "follow_up": "true", "extra": 1}')
+
+    assert reply == ask_main.LLMReply(type="command", message="", command="ls", follow_up=True)
+
+    nulls = ask_main.parse_reply('{"type": "answer", "message": "hello", "command": null, "follow_up": null}')
+
+    assert nulls == ask_main.LLMReply(type="answer", message="hello", command="", follow_up=False)
+
+    invalid = ask_main.parse_reply('{"type": "answer", "message": ["not", "a", "string"]}')
+
+    assert invalid.type == "answer"
+    assert "Invalid response" in invalid.message
+
+
+def test_call_llm_streams_deltas(monkeypatch):
+    """Streamed chunks should be requested, forwarded as they arrive, and reassembled."""
+
+    content = json.dumps({"type": "command", "message": "list", "command": "ls -la"})
+    seen_kwargs = {}
+
+    def fake_post(*args, **kwargs):
+        seen_kwargs.update(kwargs)
+        return DummyResponse(content)
+
+    monkeypatch.setattr(ask_main.http_session(), "post", fake_post)
+
+    deltas = []
+    result = ask_main.call_llm(_llm_config(), [], on_delta=deltas.append)
+
+    assert seen_kwargs["stream"] is True
+    assert json.loads(seen_kwargs["data"])["stream"] is True
+    assert len(deltas) > 1
+    assert "".join(deltas) == content
+    assert result.command == "ls -la"
+
+
+def test_request_body_matches_payload():
+    """The hand-assembled request body should decode to the equivalent JSON payload."""
+
+    cfg = _llm_config()
+    for messages in ([], [ask_main.SYSTEM_MESSAGE], [ask_main.SYSTEM_MESSAGE, {"role": "user", "content": "hi"}]):
+        body = ask_main._request_body(cfg, messages)
+
+        assert json.loads(body) == {
+            "model": "stub",
+            "temperature": 0.0,
+            "stream": True,
+            "messages": messages,
+        }
+
+
+def test_call_llm_caches_deterministic_replies(tmp_path, monkeypatch):
+    """Identical temperature-0 requests should be served from the on-disk cache."""
+
+    monkeypatch.setattr(ask_main, "config_dir", lambda: str(tmp_path))
+    calls = []
+
+    def fake_post(*args, **kwargs):
+        calls.append(kwargs["data"])
+        return DummyResponse(json.dumps({"type": "answer", "message": "cached"}))
+
+    monkeypatch.setattr(ask_main.http_session(), "post", fake_post)
+
+    cfg = _llm_config()
+    cfg.cache = True
+    messages = [{"role": "user", "content": "find big files"}]
+
+    first = ask_main.call_llm(cfg, messages)
+    second = ask_main.call_llm(cfg, messages)
+
+    assert first == second
+    assert second.message == "cached"
+    assert len(calls) == 1
+
+    ask_main.call_llm(cfg, [{"role": "user", "content": "something else"}])
+    cfg.temperature = 0.7
+    ask_main.call_llm(cfg, messages)
+    ask_main.call_llm(cfg, messages)
+
+    assert len(calls) == 4
+
+
+def test_run_batch_keeps_input_order(monkeypatch):
+    """Batch replies should line up with their queries even when answered concurrently."""
+
+    def fake_post(*args, **kwargs):
+        query = json.loads(kwargs["data"])["messages"][-1]["content"]
+        return DummyResponse(json.dumps({"type": "answer", "message": query.upper()}))
+
+    monkeypatch.setattr(ask_main.http_session(), "post", fake_post)
+
+    queries = [f"query {i}" for i in range(10)]
+    replies = ask_main.run_batch(_llm_config(), queries)
+
+    assert [r.message for r in replies] == [q.upper() for q in queries]
+
+
+def test_call_llm_does_not_cache_bad_replies(tmp_path, monkeypatch):
+    """Empty or non-JSON completions must not be cached, so a healthy retry reaches the server."""
+
+    monkeypatch.setattr(ask_main, "config_dir", lambda: str(tmp_path))
+    replies = iter(["", "not json", json.dumps({"type": "answer", "message": "ok"})])
+
+    def fake_post(*args, **kwargs):
+        return DummyResponse(next(replies))
+
+    monkeypatch.setattr(ask_main.http_session(), "post", fake_post)
+
+    cfg = _llm_config()
+    cfg.cache = True
+    messages = [{"role": "user", "content": "find big files"}]
+
+    assert "Non-JSON response" in ask_main.call_llm(cfg, messages).message
+    assert "Non-JSON response" in ask_main.call_llm(cfg, messages).message
+    assert ask_main.call_llm(cfg, messages).message == "ok"
+    assert ask_main.call_llm(cfg, messages).message == "ok"
+
+
+def test_run_batch_reports_failures_per_query(tmp_path, monkeypatch):
+    """Duplicate lines share the cache safely, and one failed request doesn't sink the rest."""
+
+    monkeypatch.setattr(ask_main, "config_dir", lambda: str(tmp_path))
+
+    def fake_post(*args, **kwargs):
+        query = json.loads(kwargs["data"])["messages"][-1]["content"]
+        if query == "broken":
+            raise requests.HTTPError("500 Server Error")
+        return DummyResponse(json.dumps({"type": "answer", "message": query.upper()}))
+
+    monkeypatch.setattr(ask_main.http_session(), "post", fake_post)
+
+    cfg = _llm_config()
+    cfg.cache = True
+    queries = ["same"] * 8 + ["broken", "last"]
+    replies = ask_main.run_batch(cfg, queries)
+
+    assert [r.message for r in replies[:8]] == ["SAME"] * 8
+    assert isinstance(replies[8], requests.HTTPError)
+    assert replies[9].message == "LAST"
+    assert not list(tmp_path.glob("cache/*/*.tmp"))
+
+
+def test_http_session_is_reused():
+    """Every call should share one pooled session so keep-alive sockets are reused."""
+
+    assert ask_main.http_session() is ask_main.http_session()
+
+
+def test_import_defers_heavy_modules():
+    """Importing the CLI module should not load rich, prompt_toolkit or requests."""
+
+    script = (
+        "import sys, ask.main; "
+        "print(sorted(m for m in ('rich', 'prompt_toolkit', 'requests') if m in sys.modules))"
+    )
+    out = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+
+    assert out.stdout.strip() == "[]"
+
+
+def test_path_completer_is_shared():
+    """The TAB completer should be built once and reused for every prompt."""
+
+    assert ask_main.path_completer() is ask_main.path_completer()
+
+
+def test_confirm_prompt_has_no_path_completion():
+    """Follow-up prompts complete paths; the y/N confirmation must not."""
+
+    class FakeSession:
+        def __init__(self, reply):
+            self.reply = reply
+            self.completers = []
+
+        def prompt(self, text, completer=None):
+            self.completers.append(completer)
+            return self.reply
+
+    session = FakeSession(" Yes ")
+
+    assert ask_main.interactive_followups(session, "Answer: ") == " Yes "
+    assert ask_main.confirm(session, "Run this? [y/N]: ") is True
+    assert session.completers == [ask_main.path_completer(), ask_main.no_completer()]
+    assert ask_main.confirm(FakeSession(""), "Run this? [y/N]: ") is False
+
+
+def test_warm_connection_ignores_unreachable_server(monkeypatch):
+    """Warming the connection is best effort and must not raise if the server is down."""
+
+    calls = []
+
+    def fake_head(url, **kwargs):
+        calls.append(url)
+        assert kwargs["timeout"] == ask_main.WARM_TIMEOUT_S
+        raise requests.ConnectionError("refused")
+
+    monkeypatch.setattr(ask_main.http_session(), "head", fake_head)
+
+    ask_main.warm_connection(_llm_config())
+
+    assert calls == ["http://localhost:1234"]
 
 
 def test_session_round_trip(tmp_path, monkeypatch):
@@ -94,3 +308,241 @@ def test_session_round_trip(tmp_path, monkeypatch):
     loaded = ask_main.load_session()
 
     assert loaded == messages
+
+
+def test_session_append_is_incremental(tmp_path, monkeypatch):
+    """append_session writes one line per message and tolerates a corrupt tail."""
+
+    monkeypatch.setattr(ask_main, "config_dir", lambda: str(tmp_path))
+
+    messages = [{"role": "user", "content": f"msg {i}"} for i in range(5)]
+    for message in messages:
+        ask_main.append_session(message)
+    ask_main.flush_session()
+    with open(ask_main.session_path(), "ab") as f:
+        f.write(b'{"role": "user", "cont')
+
+    assert ask_main.load_session() == messages
+    assert ask_main.load_session(limit=2) == messages[-2:]
+
+
+def test_session_appends_are_batched(tmp_path, monkeypatch):
+    """Appends should reach disk in batches, with flush_session writing the remainder."""
+
+    monkeypatch.setattr(ask_main, "config_dir", lambda: str(tmp_path))
+    monkeypatch.setattr(ask_main, "SESSION_FLUSH_EVERY", 3)
+
+    messages = [{"role": "user", "content": f"msg {i}"} for i in range(4)]
+    for message in messages:
+        ask_main.append_session(message)
+
+    assert ask_main.load_session() == messages[:3]
+
+    ask_main.flush_session()
+
+    assert ask_main.load_session() == messages
+
+
+def test_save_session_replaces_atomically(tmp_path, monkeypatch):
+    """save_session should leave no temp file behind and overwrite the previous log."""
+
+    monkeypatch.setattr(ask_main, "config_dir", lambda: str(tmp_path))
+
+    ask_main.save_session([{"role": "user", "content": "old"}])
+    ask_main.save_session([{"role": "user", "content": "new"}])
+
+    assert ask_main.load_session() == [{"role": "user", "content": "new"}]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["session.jsonl"]
+
+
+def test_compact_reply_drops_json_envelope():
+    """Assistant turns are replayed as plain text, keeping any proposed command."""
+
+    answer = ask_main.LLMReply(type="answer", message="Paris.")
+    command = ask_main.LLMReply(type="command", message="Lists files.", command="ls -la")
+
+    assert ask_main.compact_reply(answer) == "Paris."
+    assert ask_main.compact_reply(command) == "Lists files.\nCommand: ls -la"
+
+    raw = {"role": "assistant", "content": json.dumps({"type": "command", "message": "Lists files.", "command": "ls -la"})}
+    user = {"role": "user", "content": "{}"}
+
+    assert ask_main.compact_message(raw) == {"role": "assistant", "content": "Lists files.\nCommand: ls -la"}
+    assert ask_main.compact_message(user) is user
+    assert ask_main.compact_message({"role": "assistant", "content": "plain"}) == {"role": "assistant", "content": "plain"}
+
+
+def test_prompt_window_keeps_system_and_recent_turns():
+    """Only the system prefix and the last N exchanges should be sent to the LLM."""
+
+    system = {"role": "system", "content": "sys"}
+    history = [{"role": "user" if i % 2 == 0 else "assistant", "content": str(i)} for i in range(10)]
+    messages = [system] + history
+
+    assert ask_main.prompt_window(messages, 2) == [system] + history[-4:]
+    assert ask_main.prompt_window(messages, 20) == messages
+    assert ask_main.prompt_window(messages, 0) == messages
+
+
+def _turn(**flags):
+    args = argparse.Namespace(run=flags.get("run", False), yes=flags.get("yes", False))
+    return ask_main.TurnContext(args=args, cfg=_llm_config(), session=None)
+
+
+def test_handlers_dispatch_by_reply_type():
+    """Answers only continue when follow-ups are allowed; unknown types always stop."""
+
+    follow_up = ask_main.LLMReply(type="answer", message="hi", follow_up=True)
+
+    assert ask_main.HANDLERS["answer"](_turn(run=True), follow_up) == (ask_main.CONTINUE, None)
+    assert ask_main.HANDLERS["answer"](_turn(), follow_up) == (ask_main.BREAK, None)
+    assert ask_main.handle_unknown(_turn(), ask_main.LLMReply(type="weird")) == (ask_main.BREAK, None)
+
+
+def test_select_handler_skips_broken_command_replies():
+    """A command reply without a command gets its own handler, which is never recorded."""
+
+    assert ask_main.select_handler(ask_main.LLMReply(type=" Command ", command="ls")) is ask_main.handle_command
+    assert ask_main.select_handler(ask_main.LLMReply(type="command", command="  ")) is ask_main.handle_missing_command
+    assert ask_main.select_handler(ask_main.LLMReply(type="weird")) is ask_main.handle_unknown
+    assert ask_main.handle_missing_command in ask_main._UNRECORDED
+    assert ask_main.handle_command not in ask_main._UNRECORDED
+
+
+def test_handle_command_without_run_does_not_execute(monkeypatch):
+    """Without --run/--yes the command is only shown, never executed."""
+
+    def fail(cmd):
+        raise AssertionError("command should not run")
+
+    monkeypatch.setattr(ask_main, "run_with_live_output", fail)
+
+    result = ask_main.LLMReply(type="command", command="ls", follow_up=True)
+
+    assert ask_main.handle_command(_turn(), result) == (ask_main.BREAK, None)
+
+
+def test_handle_command_warms_connection_only_for_follow_ups(monkeypatch):
+    """The warm-up thread only starts when another LLM turn will follow the command."""
+
+    warmed = []
+
+    def fake_run(cmd):
+        return ask_main.CommandResult([cmd], 0, ask_main.OutputCapture(), ask_main.OutputCapture())
+
+    monkeypatch.setattr(ask_main, "run_with_live_output", fake_run)
+    monkeypatch.setattr(ask_main, "warm_connection", warmed.append)
+
+    no_follow_up = ask_main.LLMReply(type="command", command="ls", follow_up=False)
+    follow_up = ask_main.LLMReply(type="command", command="ls", follow_up=True)
+
+    action, outcome = ask_main.handle_command(_turn(run=True, yes=True), no_follow_up)
+
+    assert action == ask_main.BREAK
+    assert "exit code 0" in outcome
+    assert warmed == []
+
+    action, _ = ask_main.handle_command(_turn(run=True, yes=True), follow_up)
+
+    assert action == ask_main.CONTINUE
+    assert len(warmed) == 1
+
+
+def test_fast_path_reply_only_matches_trivial_queries():
+    """Greetings and help are answered locally; anything else goes to the LLM."""
+
+    assert ask_main.fast_path_reply("  Hello! ") is not None
+    assert "--help" in ask_main.fast_path_reply("help")
+    assert ask_main.fast_path_reply("version").startswith("ask ")
+    assert ask_main.fast_path_reply("help me find large files") is None
+
+
+def test_package_version_matches_pyproject():
+    """The fallback version reported by the fast path must match the packaged version."""
+
+    pyproject = (pathlib.Path(__file__).parents[1] / "pyproject.toml").read_text(encoding="utf-8")
+    declared = re.search(r'^version = "([^"]+)"', pyproject, re.MULTILINE).group(1)
+
+    assert ask.__version__ == declared
+
+
+def test_output_capture_render_keeps_head_and_tail():
+    """Long output should be elided in the middle, short output left alone."""
+
+    short = ask_main.OutputCapture()
+    short.feed(b"short")
+
+    assert short.render(max_bytes=16) == "short"
+
+    capture = ask_main.OutputCapture()
+    capture.feed(b"A" * 100 + b"B" * 100)
+    truncated = capture.render(max_bytes=20)
+
+    assert truncated.startswith("A" * 10)
+    assert truncated.endswith("B" * 10)
+    assert "[180 bytes elided]" in truncated
+    assert capture.render() == "A" * 100 + "B" * 100
+
+def test_run_process_streams_both_pipes():
+    """Output from both pipes should be streamed to the callback and captured."""
+
+    script = "import sys; print('out'); print('err', file=sys.stderr); sys.exit(3)"
+    seen = []
+
+    completed = ask_main._run_process(
+        [sys.executable, "-c", script], lambda name, text: seen.append((name, text))
+    )
+
+    assert completed.returncode == 3
+    assert completed.stdout == "out\n"
+    assert completed.stderr == "err\n"
+    assert "".join(text for name, text in seen if name == "stdout") == "out\n"
+    assert "".join(text for name, text in seen if name == "stderr") == "err\n"
+
+
+def test_run_process_bounds_capture_by_bytes(monkeypatch):
+    """Long output keeps its real head and tail, and the elision counts every dropped byte."""
+
+    monkeypatch.setattr(ask_main, "CAPTURE_BYTES", 1024)
+    script = "for i in range(20000): print('line', i)"
+    total = sum(len(f"line {i}\n") for i in range(20000))
+
+    completed = ask_main._run_process([sys.executable, "-c", script])
+
+    assert completed.stdout.startswith("line 0\nline 1\n")
+    assert completed.stdout.endswith("line 19999\n")
+    assert f"[{total - 2048} bytes elided]" in completed.stdout
+    assert completed.stdout_capture.dropped
+
+    capped = completed.stdout_capture.render(100)
+
+    assert capped.startswith("line 0\n")
+    assert capped.endswith("line 19999\n")
+    assert f"[{total - 100} bytes elided]" in capped
+
+
+def test_direct_argv_only_for_simple_commands():
+    """Plain commands skip the shell; anything using shell syntax or builtins does not."""
+
+    assert ask_main._direct_argv("ls -la 'My Folder'") == ["ls", "-la", "My Folder"]
+    assert ask_main._direct_argv("du -sh * | sort -h") is None
+    assert ask_main._direct_argv("echo $HOME") is None
+    assert ask_main._direct_argv("cd ~/Downloads") is None
+    assert ask_main._direct_argv("FOO=1 env") is None
+    assert ask_main._direct_argv("echo 'a\\tb'") is None
+    assert ask_main._direct_argv("which python") is None
+    assert ask_main._direct_argv("time ls") is None
+    assert ask_main._direct_argv("ls -l =python3") is None
+    assert ask_main._direct_argv("ls -l a=b") == ["ls", "-l", "a=b"]
+    assert ask_main._direct_argv("definitely-not-a-real-command") is None
+    assert ask_main._direct_argv("echo 'unterminated") is None
+
+
+def test_run_shell_command_execs_simple_commands_directly():
+    """A simple command should run without needing zsh at all."""
+
+    completed = ask_main.run_shell_command("ls -d .")
+
+    assert completed.args == ["ls", "-d", "."]
+    assert completed.returncode == 0
+    assert completed.stdout == ".\n"